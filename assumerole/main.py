@@ -14,44 +14,65 @@ Options:
         Specify session duration. Use "aws iam get-role" to check max duration
         confirmed for that session - if you ask for more than that, the request
         will be denied by AWS.
+    --refresh
+        Ignore cached credentials and request new ones from AWS.
     --debug
         Enable debug log.
 """
+import functools
 import json
 import logging
 import os
 import pwd
 import socket
+import sys
+import tempfile
 from datetime import datetime, timedelta
-from json import JSONDecodeError
 from pathlib import Path
 
-import boto3
-import coloredlogs
-import humanize as humanize
-import pytz as pytz
-import questionary
-from botocore.session import Session
 from docopt import docopt
 
-# Set up logging
-# TODO: This log config should only be active when using the CLI
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Heavy dependencies (botocore, coloredlogs, humanize, pytz) are imported
+# inside the functions that use them, so that "assume --help" and runs served
+# from cached credentials don't pay for loading them.
+
 log = logging.getLogger(__name__)
 fmt = "%(programname)s:%(lineno)d %(levelname)s %(message)s"
-coloredlogs.install(fmt=fmt, level="INFO", logger=log)
 
-CACHE_FILE = Path("~").expanduser() / ".local/share/assumerole/cache.json"
+# Cached credentials closer than this to expiring are not reused
+CREDS_MIN_REMAINING = timedelta(minutes=5)
+
+# Fields of an assume-role response's credentials that we cache
+CREDS_FIELDS = ("AccessKeyId", "SecretAccessKey", "SessionToken", "Expiration")
+
+# Raw cache contents from the last load or write. The key identifies the file
+# version: mtime alone isn't enough, since a file renamed into place can share
+# the old one's mtime on filesystems with coarse timestamps. Bytes are kept
+# rather than the parsed dict, since callers modify the dict they get and
+# re-parsing is cheaper than copying it.
+_CACHE_MEM = {"key": None, "raw": None}
 
 
 def cli():
     args = docopt(__doc__)
 
-    if args['--debug']:
-        coloredlogs.install(fmt=fmt, level="DEBUG", logger=log)
+    # Set up logging
+    import coloredlogs
+
+    level = "DEBUG" if args["--debug"] else "INFO"
+    coloredlogs.install(fmt=fmt, level=level, logger=log)
 
     # Compose command and print
     duration = int(args["--duration"] or 0)
-    auth = assume_profile_role(args["PROFILE"], args["--session"], duration)
+    use_cache = not args["--refresh"]
+    auth = assume_profile_role(
+        args["PROFILE"], args["--session"], duration, use_cache
+    )
     envars = compose_envars(auth)
 
     print(envars)
@@ -64,12 +85,15 @@ def get_default_session_name():
     [1] https://docs.aws.amazon.com/sdkref/latest/guide/setting-global-role_session_name.html
     """
 
-    user = pwd.getpwuid(os.getuid()).pw_name
-    host, _, _ = socket.gethostname().partition(".")
+    # Prefer the environment, since looking up the user can be slow with
+    # network-backed user databases (LDAP etc.)
+    user = os.environ.get("USER") or pwd.getpwuid(os.getuid()).pw_name
+    host = os.environ.get("HOSTNAME") or socket.gethostname()
+    host, _, _ = host.partition(".")
     return f"{user}@{host}"
 
 
-def get_max_duration(role_arn):
+def get_max_duration(cache, role_arn):
     """
     Best guess for max duration allowed by role.
 
@@ -86,7 +110,6 @@ def get_max_duration(role_arn):
     [1]: https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use.html#id_roles_use_view-role-max-session
     """
 
-    cache = load_cache()
     if not cache:
         return 0
 
@@ -101,15 +124,107 @@ def get_max_duration(role_arn):
     return cache["MaxSessionDuration"][role_arn]
 
 
-def assume_profile_role(role_profile, session_name="", session_duration=0):
-    """Assume role described by role_profile and return the auth response."""
+def aws_config_key():
+    """Identify the current version of the AWS config file, or None if there is
+    none. Compared against cached credentials so they are dropped whenever the
+    config (and therefore possibly the profile's role) changes, without having
+    to load botocore to parse it."""
+
+    path = os.environ.get("AWS_CONFIG_FILE", "~/.aws/config")
+    try:
+        return list(_stat_key(os.stat(os.path.expanduser(path))))
+    except FileNotFoundError:
+        return None
+
+
+def load_creds(cache, role_profile):
+    """
+    Return cached credentials for role_profile, or None if there are none, the
+    AWS config changed since they were cached, or they expire too soon to be
+    worth reusing.
+
+    Credentials are cached per profile rather than per role, since profiles
+    sharing a role may still differ in source profile or MFA device.
+    """
+
+    import pytz
+
+    creds = cache.get("Credentials", {}).get(role_profile)
+    if not creds:
+        log.debug(f"No cached credentials found for profile {role_profile}.")
+        return None
+
+    config_key = aws_config_key()
+    if config_key is None or creds.get("Config") != config_key:
+        log.debug(f"AWS config changed since {role_profile} was cached.")
+        return None
+
+    # Treat entries we can't make sense of as missing, so we fall back to STS
+    # instead of failing on every run
+    if not all(creds.get(field) for field in CREDS_FIELDS):
+        log.debug(f"Cached credentials for {role_profile} are incomplete.")
+        return None
+
+    creds = {field: creds[field] for field in CREDS_FIELDS}
+    try:
+        creds["Expiration"] = datetime.fromisoformat(creds["Expiration"])
+    except (TypeError, ValueError):
+        log.debug(f"Cached credentials for {role_profile} have a bad expiration.")
+        return None
+
+    if creds["Expiration"].tzinfo is None:
+        log.debug(f"Cached credentials for {role_profile} have no time zone.")
+        return None
+
+    if creds["Expiration"] - datetime.now(pytz.utc) < CREDS_MIN_REMAINING:
+        log.debug(f"Cached credentials for {role_profile} are about to expire.")
+        return None
+
+    return creds
+
+
+def cache_creds(cache, role_profile, creds):
+    cached = dict(creds)
+    cached["Expiration"] = creds["Expiration"].isoformat()
+    cached["Config"] = aws_config_key()
+    cache.setdefault("Credentials", {})[role_profile] = cached
+
+
+def assume_profile_role(
+    role_profile, session_name="", session_duration=0, use_cache=True
+):
+    """Assume role described by role_profile and return the auth response.
+
+    If use_cache is set and still-valid credentials for the profile were cached
+    by a previous run, they are returned without contacting AWS. Only requests
+    with the default session name and duration use the cache, in either
+    direction: an explicit session name or duration always requests new
+    credentials, and those credentials aren't cached for later default runs.
+    """
+    default_request = not session_name and not session_duration
+
+    # Reuse credentials from a previous run if possible. This happens before
+    # importing botocore, which is most of the cost of a run.
+    cache = load_cache()
+    if use_cache and default_request:
+        creds = load_creds(cache, role_profile)
+        if creds:
+            log.info("Using cached credentials.")
+            response = {"Credentials": creds}
+            log_expiration(response)
+            return response
+
+    import humanize
+    from botocore.session import Session
 
     # Get local profile config
-    config = Session(profile=role_profile).get_scoped_config()
+    session = Session(profile=role_profile)
+    config = session.get_scoped_config()
 
     # Construct assume role request
     assert "role_arn" in config, f"{role_profile} does not have role_arn."
     role_arn = config["role_arn"]
+
     rq = {
         "RoleArn": role_arn,
         "RoleSessionName": session_name or get_default_session_name(),
@@ -118,7 +233,7 @@ def assume_profile_role(role_profile, session_name="", session_duration=0):
 
     # Specify duration if one was given
     if not session_duration:
-        best_max = get_max_duration(role_arn)
+        best_max = get_max_duration(cache, role_arn)
         dt = timedelta(seconds=best_max)
         log.debug(f"Using duration of {humanize.naturaldelta(dt)} based on cache.")
         session_duration = best_max
@@ -131,90 +246,180 @@ def assume_profile_role(role_profile, session_name="", session_duration=0):
     # Add MFA token if needed
     if "mfa_serial" in config:
         rq["SerialNumber"] = config["mfa_serial"]
-        rq["TokenCode"] = questionary.text("Enter MFA code:").ask()
+        rq["TokenCode"] = prompt("Enter MFA code: ").strip()
+        if not rq["TokenCode"]:
+            # Also happens on EOF, e.g. when stdin is closed
+            raise ValueError("No MFA code entered.")
 
     # Log request before making it
-    log.debug(f"Auth request:\n{json.dumps(rq, indent=4)}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Auth request:\n%s", json.dumps(rq, indent=2))
 
     # If source_profile is given, we should use it instead of the default profile
     source_profile = config.get("source_profile")
     log.info(f"Using source profile: {source_profile}")
 
-    # Get auth token
-    session = boto3.Session(profile_name=source_profile)
-    sts = session.client("sts")
+    # Get auth token. Reuse the session so the AWS config is only parsed once;
+    # credentials haven't been resolved yet, so switching its profile is safe.
+    session.set_config_variable("profile", source_profile)
+    sts = session.create_client("sts")
     response = sts.assume_role(**rq)
 
-    # Cache session duration
+    # Cache session duration and credentials for subsequent runs
     if session_duration:
-        cache_max_duration(role_arn, session_duration)
+        cache_max_duration(cache, role_arn, session_duration)
+    if default_request:
+        cache_creds(cache, role_profile, response["Credentials"])
+    write_cache(cache)
 
     # Log auth token
-    resp_str = json.dumps(response, indent=4, default=lambda o: str(o))
-    log.debug(f"Auth response:\n{resp_str}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Auth response:\n%s", json.dumps(response, indent=2, default=str))
+
+    log_expiration(response)
+
+    return response
+
+
+def prompt(message):
+    """Like input(), but writes the prompt to stderr. Stdout is usually
+    captured by the shell (as in "$(assume PROFILE)"), so the user wouldn't
+    see a prompt written there."""
+
+    print(message, end="", file=sys.stderr, flush=True)
+    return sys.stdin.readline()
+
+
+def log_expiration(response):
+    """Log when the credentials in an auth response will expire."""
+    import humanize
+    import pytz
 
-    # Log expiration date
     local_exp = response["Credentials"]["Expiration"].astimezone()
     remaining = humanize.naturaldelta(local_exp - datetime.now(pytz.utc))
     log.info(f"The token will expire after {remaining} on {local_exp}")
 
-    return response
+
+@functools.lru_cache(maxsize=None)
+def cache_file():
+    """Location of the cache, following the XDG base directory spec."""
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(
+        "~/.local/share"
+    )
+    return Path(data_home) / "assumerole/cache.json"
 
 
 def load_cache():
     # Default empty cache that will be returned if no valid cache found
     default = {}
 
-    p = Path(CACHE_FILE)
+    p = cache_file()
     log.debug(f"Looking for cache file at: {p}")
-    if not p.exists():
+    try:
+        with open(p, "rb") as f:
+            key = _stat_key(os.fstat(f.fileno()))
+
+            # Skip reading if the file hasn't changed since we last read or
+            # wrote it
+            if key == _CACHE_MEM["key"]:
+                log.debug("Using already loaded cache.")
+                raw = _CACHE_MEM["raw"]
+            else:
+                raw = f.read()
+    except FileNotFoundError:
         log.debug("No cache file found.")
         return default
 
     log.debug("Found cache.")
     try:
-        cache = json.loads(p.read_text())
-    except JSONDecodeError:
-        # When the file is corrupted, it's usually because the previous write failed
+        cache = _loads(raw)
+        if not isinstance(cache, dict):
+            raise ValueError("Cache is not a JSON object.")
+    except ValueError:
+        # ValueError covers JSONDecodeError (stdlib and orjson) as well as
+        # UnicodeDecodeError. Writes are atomic, so this should only happen if
+        # the file was edited by hand or written by an older version.
         newp = p.with_name("corrupt.json")
         msg = (
             f"Cache is corrupt. It will be moved to {newp} and the program "
             f"will proceed as if you had no cache."
         )
         log.warning(msg)
+        os.replace(p, newp)
         return {}
 
+    _CACHE_MEM["key"] = key
+    _CACHE_MEM["raw"] = raw
     return cache
 
 
 def write_cache(data):
-    p = Path(CACHE_FILE)
+    p = cache_file()
 
+    # Another run may be creating the directory at the same time
     pdir = p.parent
-    if not pdir.exists():
-        log.debug(f"Creating directory: {pdir}")
-        pdir.mkdir(parents=True)
+    pdir.mkdir(parents=True, exist_ok=True)
 
+    # The cache holds credentials, so keep it private. Write to a temporary
+    # file and rename it into place so readers never see a partial write.
+    # mkstemp creates a new file with mode 0600 and a unique name, so
+    # concurrent runs don't write into each other's temporary file.
     log.debug(f"Writing cache to: {p}")
-    p.write_text(json.dumps(data, indent=4))
+    raw = _dumps(data)
+    fd, tmp = tempfile.mkstemp(dir=pdir, prefix=".cache-", suffix=".json.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+            key = _stat_key(os.fstat(f.fileno()))
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
+    _CACHE_MEM["key"] = key
+    _CACHE_MEM["raw"] = raw
 
-def cache_max_duration(role_arn, session_duration):
-    cache = load_cache()
+
+def _stat_key(st):
+    """Identify a version of the cache file by its stat result."""
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _loads(raw):
+    """Parse cache contents, with orjson if it's installed."""
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _dumps(data):
+    """Serialize cache contents to bytes, with orjson if it's installed."""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+
+def cache_max_duration(cache, role_arn, session_duration):
     max_durations = cache.setdefault("MaxSessionDuration", {})
     if session_duration > max_durations.get(role_arn, 0):
         max_durations[role_arn] = session_duration
-        write_cache(cache)
 
 
 def compose_envars(auth_response):
     """Given response from assume-role, compose shell commands for setting auth
     environment variables."""
     creds = auth_response["Credentials"]
-    envars = {
-        "AWS_ACCESS_KEY_ID": creds["AccessKeyId"],
-        "AWS_SECRET_ACCESS_KEY": creds["SecretAccessKey"],
-        "AWS_SESSION_TOKEN": creds["SessionToken"],
-    }
-
-    return "\n".join(f"export {k}={v}" for k, v in envars.items())
+    missing = [f for f in CREDS_FIELDS[:3] if not creds.get(f)]
+    if missing:
+        msg = f"Auth response is missing credentials: {', '.join(missing)}"
+        raise ValueError(msg)
+
+    return "\n".join(
+        (
+            f"export AWS_ACCESS_KEY_ID={creds['AccessKeyId']}",
+            f"export AWS_SECRET_ACCESS_KEY={creds['SecretAccessKey']}",
+            f"export AWS_SESSION_TOKEN={creds['SessionToken']}",
+        )
+    )
@@ -0,0 +1,300 @@
+import io
+import os
+import stat
+import sys
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from assumerole import main
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/test"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Point the cache and AWS config at a temporary directory for each test."""
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path))
+    aws_config = tmp_path / "aws_config"
+    aws_config.write_text(f"[profile dev]\nrole_arn = {ROLE_ARN}\n")
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(aws_config))
+    main.cache_file.cache_clear()
+    monkeypatch.setattr(main, "_CACHE_MEM", {"key": None, "raw": None})
+    yield tmp_path / "assumerole"
+    main.cache_file.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def restore_logger():
+    """Undo logging setup done by cli(), e.g. coloredlogs handlers."""
+    handlers, level = list(main.log.handlers), main.log.level
+    yield
+    main.log.handlers[:] = handlers
+    main.log.setLevel(level)
+
+
+def make_creds(expires_in=timedelta(hours=1), key_id="AKIAOLD"):
+    return {
+        "AccessKeyId": key_id,
+        "SecretAccessKey": "secret",
+        "SessionToken": "token",
+        "Expiration": datetime.now(timezone.utc) + expires_in,
+    }
+
+
+class FakeSTS:
+    def __init__(self):
+        self.config = {"role_arn": ROLE_ARN}
+        self.requests = []
+
+    def assume_role(self, **rq):
+        self.requests.append(rq)
+        return {"Credentials": make_creds(key_id="AKIANEW")}
+
+
+@pytest.fixture
+def sts(monkeypatch):
+    """Replace botocore's session with one that never contacts AWS."""
+    import botocore.session
+
+    fake_sts = FakeSTS()
+
+    class FakeSession:
+        def __init__(self, profile=None):
+            pass
+
+        def get_scoped_config(self):
+            return fake_sts.config
+
+        def set_config_variable(self, name, value):
+            pass
+
+        def create_client(self, service):
+            assert service == "sts"
+            return fake_sts
+
+    monkeypatch.setattr(botocore.session, "Session", FakeSession)
+    return fake_sts
+
+
+def test_default_session_name_from_env(monkeypatch):
+    def fail(*args):
+        raise AssertionError("should not be called")
+
+    monkeypatch.setenv("USER", "alice")
+    monkeypatch.setenv("HOSTNAME", "box.example.com")
+    monkeypatch.setattr(main.pwd, "getpwuid", fail)
+    monkeypatch.setattr(main.socket, "gethostname", fail)
+
+    assert main.get_default_session_name() == "alice@box"
+
+
+def test_default_session_name_fallback(monkeypatch):
+    monkeypatch.delenv("USER", raising=False)
+    monkeypatch.delenv("HOSTNAME", raising=False)
+    monkeypatch.setattr(
+        main.pwd, "getpwuid", lambda uid: types.SimpleNamespace(pw_name="bob")
+    )
+    monkeypatch.setattr(main.socket, "gethostname", lambda: "host.example.com")
+
+    assert main.get_default_session_name() == "bob@host"
+
+
+def test_creds_round_trip():
+    cache = {}
+    creds = make_creds()
+    main.cache_creds(cache, "dev", creds)
+
+    assert main.load_creds(cache, "dev") == creds
+
+
+@pytest.mark.parametrize(
+    "expires_in, hit",
+    [(timedelta(minutes=4), False), (timedelta(minutes=6), True)],
+)
+def test_creds_expiry_cutoff(expires_in, hit):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds(expires_in))
+
+    assert (main.load_creds(cache, "dev") is not None) == hit
+
+
+def test_creds_dropped_when_config_changes(tmp_path):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds())
+    assert main.load_creds(cache, "prod") is None
+
+    aws_config = tmp_path / "aws_config"
+    aws_config.write_text(f"[profile dev]\nrole_arn = {ROLE_ARN}-other\n")
+    assert main.load_creds(cache, "dev") is None
+
+
+@pytest.mark.parametrize(
+    "field, value",
+    [
+        ("Expiration", None),
+        ("Expiration", "not a date"),
+        ("Expiration", "2030-01-01T00:00:00"),
+        ("Expiration", 12345),
+        ("SessionToken", None),
+    ],
+)
+def test_malformed_creds_are_a_miss(field, value):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds())
+    entry = cache["Credentials"]["dev"]
+    if value is None:
+        del entry[field]
+    else:
+        entry[field] = value
+
+    assert main.load_creds(cache, "dev") is None
+
+
+def test_cache_hit_skips_sts(sts):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds())
+    main.write_cache(cache)
+
+    response = main.assume_profile_role("dev")
+
+    assert response["Credentials"]["AccessKeyId"] == "AKIAOLD"
+    assert sts.requests == []
+
+
+def test_cache_hit_skips_botocore(monkeypatch):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds())
+    main.write_cache(cache)
+
+    # Make any import of botocore.session fail
+    monkeypatch.setitem(sys.modules, "botocore.session", None)
+    response = main.assume_profile_role("dev")
+
+    assert response["Credentials"]["AccessKeyId"] == "AKIAOLD"
+
+
+@pytest.mark.parametrize(
+    "kwargs, cached_key_id",
+    [
+        ({"use_cache": False}, "AKIANEW"),
+        ({"session_name": "me"}, "AKIAOLD"),
+        ({"session_duration": 3600}, "AKIAOLD"),
+    ],
+)
+def test_cache_bypassed(sts, kwargs, cached_key_id):
+    cache = {}
+    main.cache_creds(cache, "dev", make_creds())
+    main.write_cache(cache)
+
+    response = main.assume_profile_role("dev", **kwargs)
+
+    assert response["Credentials"]["AccessKeyId"] == "AKIANEW"
+    assert len(sts.requests) == 1
+
+    # Credentials for non-default requests must not be reused by default runs
+    cached = main.load_cache()["Credentials"]["dev"]
+    assert cached["AccessKeyId"] == cached_key_id
+
+
+def test_prompt_writes_to_stderr(monkeypatch, capsys):
+    monkeypatch.setattr(sys, "stdin", io.StringIO("123456\n"))
+
+    assert main.prompt("Enter MFA code: ") == "123456\n"
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert err == "Enter MFA code: "
+
+
+@pytest.mark.parametrize("stdin", ["", "\n"])
+def test_empty_mfa_code_fails_before_sts(monkeypatch, sts, stdin):
+    sts.config["mfa_serial"] = "arn:aws:iam::123456789012:mfa/me"
+    monkeypatch.setattr(sys, "stdin", io.StringIO(stdin))
+
+    with pytest.raises(ValueError, match="MFA"):
+        main.assume_profile_role("dev")
+    assert sts.requests == []
+
+
+def test_cli_refresh_disables_cache(monkeypatch, capsys):
+    calls = []
+
+    def fake_assume(*args):
+        calls.append(args)
+        return {"Credentials": make_creds()}
+
+    monkeypatch.setattr(main, "assume_profile_role", fake_assume)
+    monkeypatch.setattr(sys, "argv", ["assume", "dev", "--refresh"])
+    main.cli()
+
+    assert calls == [("dev", None, 0, False)]
+    assert "export AWS_ACCESS_KEY_ID=AKIAOLD" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("xdg_data_home", [None, ""])
+def test_cache_file_default(monkeypatch, tmp_path, xdg_data_home):
+    if xdg_data_home is None:
+        monkeypatch.delenv("XDG_DATA_HOME")
+    else:
+        monkeypatch.setenv("XDG_DATA_HOME", xdg_data_home)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    main.cache_file.cache_clear()
+
+    expected = tmp_path / ".local/share/assumerole/cache.json"
+    assert main.cache_file() == expected
+
+
+def test_cache_file_honors_xdg_data_home(tmp_path):
+    assert main.cache_file() == tmp_path / "assumerole/cache.json"
+
+
+def test_write_cache_is_private_and_atomic(cache_dir):
+    main.write_cache({"a": 1})
+    main.write_cache({"a": 2})
+
+    p = main.cache_file()
+    assert stat.S_IMODE(os.stat(p).st_mode) == 0o600
+    assert os.listdir(cache_dir) == ["cache.json"]
+
+    main._CACHE_MEM["key"] = None
+    assert main.load_cache() == {"a": 2}
+
+
+def test_load_cache_returns_copy():
+    main.write_cache({"a": {"b": 1}})
+    main.load_cache()["a"]["b"] = 2
+
+    assert main.load_cache() == {"a": {"b": 1}}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_cache_round_trip(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(main, "orjson", None)
+    data = {"MaxSessionDuration": {ROLE_ARN: 3600}, "Credentials": {}}
+
+    assert main._loads(main._dumps(data)) == data
+    main.write_cache(data)
+    main._CACHE_MEM["key"] = None
+    assert main.load_cache() == data
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("contents", [b"\xff\xfe\x00", b"{bad", b"[1, 2]"])
+def test_corrupt_cache_is_moved_aside(monkeypatch, cache_dir, use_orjson, contents):
+    if not use_orjson:
+        monkeypatch.setattr(main, "orjson", None)
+    cache_dir.mkdir()
+    main.cache_file().write_bytes(contents)
+
+    assert main.load_cache() == {}
+    assert os.listdir(cache_dir) == ["corrupt.json"]
+
+
+def test_compose_envars_rejects_incomplete_creds():
+    creds = make_creds()
+    del creds["SessionToken"]
+
+    with pytest.raises(ValueError, match="SessionToken"):
+        main.compose_envars({"Credentials": creds})